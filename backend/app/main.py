@@ -1,12 +1,21 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Form
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import shutil
+import asyncio
+import aiofiles
 import os
 import uuid
 import json
-import traceback
-from .services import transcribe_audio, extract_placeholders, parse_transcript_with_ai, infer_and_fill_template, generate_filled_docx, get_template_text
+import orjson
+import logging
+import logging.handlers
+import queue
+from .services import close_groq_client, warm_up_whisper, whisper_ready, transcribe_audio, parse_transcript_with_ai, infer_and_fill_template, generate_filled_docx, load_template
+
+logger = logging.getLogger("aidoc")
+_log_listener = None
+_log_handler = None
+_warmup_task = None
 
 # Allow frontend access
 app = FastAPI(title="Dynamic Document Generator API")
@@ -24,10 +33,70 @@ TEMPLATE_DIR = "backend/templates"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
+# Whisper already saturates the CPU; running it in parallel only thrashes caches
+_whisper_semaphore = asyncio.Semaphore(1)
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+async def _save_upload(upload: UploadFile, path: str):
+    # Stream in 1 MiB chunks so large uploads never block the event loop
+    async with aiofiles.open(path, "wb") as buffer:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
+
+async def _transcribe(path: str) -> str:
+    async with _whisper_semaphore:
+        return await asyncio.to_thread(transcribe_audio, path)
+
+async def _warm_whisper():
+    try:
+        # Hold the semaphore so an early request can't start a second model load
+        async with _whisper_semaphore:
+            await asyncio.to_thread(warm_up_whisper)
+        logger.info("Whisper model ready")
+    except Exception:
+        # Not fatal: the first successful /transcribe marks the instance ready instead
+        logger.exception("Whisper warm-up failed")
+
+@app.on_event("startup")
+async def startup_event():
+    # Requests only enqueue log records; a background thread does the stderr writes
+    global _log_listener, _log_handler, _warmup_task
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+    _log_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    # Load Whisper in the background so the server can answer /healthz meanwhile
+    _warmup_task = asyncio.create_task(_warm_whisper())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global _log_listener, _log_handler
+    await close_groq_client()
+    # Detach the handler too, or a restart in the same process duplicates every log line
+    if _log_handler:
+        logger.removeHandler(_log_handler)
+        _log_handler = None
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
 @app.get("/")
 async def root():
     return {"message": "API is running. Use /transcribe or /generate-docx"}
 
+@app.get("/healthz")
+async def healthz():
+    if not whisper_ready():
+        return JSONResponse({"status": "loading"}, status_code=503)
+    return {"status": "ok"}
+
 @app.post("/transcribe")
 async def transcribe_endpoint(
     file: UploadFile = File(...),
@@ -48,8 +117,7 @@ async def transcribe_endpoint(
             custom_template_id = str(uuid.uuid4())
             custom_filename = f"custom_{custom_template_id}.docx"
             tpl_path = os.path.join(TEMPLATE_DIR, custom_filename)
-            with open(tpl_path, "wb") as buffer:
-                shutil.copyfileobj(template_file.file, buffer)
+            await _save_upload(template_file, tpl_path)
         else:
             # Use default templates based on type
             if template_type == "hr":
@@ -65,17 +133,17 @@ async def transcribe_endpoint(
         file_ext = os.path.splitext(file.filename)[1]
         save_path = os.path.join(UPLOAD_DIR, f"{file_id}{file_ext}")
         
-        with open(save_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await _save_upload(file, save_path)
             
-        # 1. Transcribe
-        transcript = transcribe_audio(save_path)
+        # 1. Transcribe + 2. Get placeholders AND full template context (overlapped)
+        transcript, template = await asyncio.gather(
+            _transcribe(save_path),
+            asyncio.to_thread(load_template, tpl_path),
+        )
+        placeholders = list(template.placeholders)
+        template_text = template.text
         if not transcript:
              raise HTTPException(status_code=500, detail="Transcription failed")
-
-        # 2. Get placeholders AND full template context
-        placeholders = extract_placeholders(tpl_path)
-        template_text = get_template_text(tpl_path)
         
         # 3. Parse with AI
         api_key = os.environ.get("GROQ_API_KEY")
@@ -83,19 +151,19 @@ async def transcribe_endpoint(
             raise HTTPException(status_code=500, detail="GROQ_API_KEY not set on server")
             
         if not placeholders:
-            print("No placeholders found. Using Smart Replacement Mode.")
+            logger.info("No placeholders found. Using Smart Replacement Mode.")
             # Smart Mode: Infer fields and values
-            inferred_response = infer_and_fill_template(transcript, template_text, api_key)
+            inferred_response = await infer_and_fill_template(transcript, template_text, api_key)
             
             # Parse JSON safely
             try:
                 if isinstance(inferred_response, str):
-                    inferred_data = json.loads(inferred_response)
+                    inferred_data = orjson.loads(inferred_response)
                 else:
                     inferred_data = inferred_response
             except:
                 inferred_data = {}
-                print("Failed to parse inferred AI response")
+                logger.warning("Failed to parse inferred AI response")
 
             # Fallback: Force Date if AI missed it
             from datetime import datetime
@@ -109,8 +177,8 @@ async def transcribe_endpoint(
             # Save metadata for later generation (maps Field -> Original Text)
             if custom_template_id and inferred_data:
                 meta_path = os.path.join(TEMPLATE_DIR, f"meta_{custom_template_id}.json")
-                with open(meta_path, "w") as f:
-                    json.dump(inferred_data, f)
+                async with aiofiles.open(meta_path, "wb") as f:
+                    await f.write(orjson.dumps(inferred_data))
             
             # Flatten for frontend: {"Field": "New Value"}
             parsed_data = {}
@@ -124,12 +192,12 @@ async def transcribe_endpoint(
 
         else:
             # Standard Placeholder Mode
-            parsed_data = parse_transcript_with_ai(transcript, placeholders, api_key, template_text)
+            parsed_data = await parse_transcript_with_ai(transcript, placeholders, api_key, template_text)
         
         # Final cleanup / Parse JSON string from AI response (for standard mode)
         if isinstance(parsed_data, str):
             try:
-                parsed_data = json.loads(parsed_data)
+                parsed_data = orjson.loads(parsed_data)
             except:
                 pass 
         
@@ -160,7 +228,7 @@ async def transcribe_endpoint(
         })
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Transcription request failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -191,10 +259,11 @@ async def generate_docx_endpoint(data: dict = Body(...)):
         if custom_template_id:
             meta_path = os.path.join(TEMPLATE_DIR, f"meta_{custom_template_id}.json")
             if os.path.exists(meta_path):
-                with open(meta_path, "r") as f:
-                    replacements = json.load(f)
+                async with aiofiles.open(meta_path, "rb") as f:
+                    replacements = orjson.loads(await f.read())
             
-        generate_filled_docx(tpl_path, filled_data, out_path, replacements=replacements)
+        # Parsing, copying and saving the docx is CPU/disk work; keep it off the event loop
+        await asyncio.to_thread(generate_filled_docx, tpl_path, filled_data, out_path, replacements=replacements)
         
         # Determine filename for download
         if custom_template_id:
@@ -207,5 +276,5 @@ async def generate_docx_endpoint(data: dict = Body(...)):
         return FileResponse(out_path, filename=download_name, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Document generation failed")
         raise HTTPException(status_code=500, detail=str(e))
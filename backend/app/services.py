@@ -1,65 +1,284 @@
 import os
-import whisper
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 import docx
+from docx.document import Document
+import numpy as np
 from docx.oxml.ns import qn
-from pydub import AudioSegment
-import requests
-import json
+import httpx
+from aiolimiter import AsyncLimiter
+import orjson
+import logging
 import re
+import asyncio
+import hashlib
+import copy
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+
+logger = logging.getLogger("aidoc")
 
 # --- CONFIG ---
-FFMPEG_DIR = os.path.join(
-    os.environ.get("LOCALAPPDATA", ""),
-    "Microsoft", "WinGet", "Packages",
-    "Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe",
-    "ffmpeg-8.0.1-full_build", "bin"
+GROQ_BASE_URL = "https://api.groq.com"
+GROQ_CHAT_PATH = "/openai/v1/chat/completions"
+GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_MAX_RETRIES = 3
+GROQ_REQUESTS_PER_MINUTE = int(os.environ.get("GROQ_RPM", "30"))
+
+PLACEHOLDER_RE = re.compile(r'\[([^\[\]]+)\]')
+
+# Shared HTTP/2 client: keeps the TLS connection to Groq alive across requests
+_groq_client = httpx.AsyncClient(
+    base_url=GROQ_BASE_URL,
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
 )
-if os.path.isdir(FFMPEG_DIR):
-    os.environ["PATH"] = FFMPEG_DIR + os.pathsep + os.environ.get("PATH", "")
 
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
-GROQ_MODEL = "llama-3.3-70b-versatile"
+# Queue requests locally at the account's RPM instead of bursting into 429s
+_groq_limiter = AsyncLimiter(GROQ_REQUESTS_PER_MINUTE, 60)
+
+async def close_groq_client():
+    await _groq_client.aclose()
+
+async def _post_groq(headers: dict, payload: dict) -> str:
+    """POST a chat completion to Groq, backing off on 429/5xx. Returns the message content."""
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        async with _groq_limiter:
+            response = await _groq_client.post(GROQ_CHAT_PATH, headers=headers, content=orjson.dumps(payload))
+        retryable = response.status_code == 429 or response.status_code >= 500
+        if not retryable or attempt == GROQ_MAX_RETRIES:
+            break
+        # Honour Retry-After when Groq sends it, otherwise exponential backoff
+        try:
+            delay = float(response.headers.get("retry-after", ""))
+        except ValueError:
+            delay = 2 ** attempt
+        await asyncio.sleep(min(delay, 30))
+    response.raise_for_status()
+    return orjson.loads(response.content)['choices'][0]['message']['content']
+
+async def _groq_chat(api_key: str, system_prompt: str, user_prompt: str) -> str:
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": GROQ_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "temperature": 0.1,
+        "response_format": {"type": "json_object"}
+    }
+    return await _post_groq(headers, payload)
+
+GROQ_BATCH_MAX = 4
+# Off by default: a batched call sends several users' transcripts in one prompt
+GROQ_BATCH_REQUESTS = os.environ.get("GROQ_BATCH_REQUESTS", "0") == "1"
+
+BATCH_PROMPT_SUFFIX = """
+
+BATCH MODE: The user message contains several independent requests, each starting with "### INPUT <n>".
+Handle each one on its own and never mix information between inputs.
+This overrides the output shape in rule 5: return a single outer JSON object whose keys are the input numbers as strings ("0", "1", ...).
+Each value is the object you would return for that input alone. Rules 1-10 (including "FLAT, string values only") apply to each inner object; only the outer object is keyed by input number."""
+
+class _GroqCoalescer:
+    """Folds requests that arrive while a Groq call is in flight into the next call to save RPM quota.
+
+    A request with nothing in flight is sent immediately, so a lone caller never waits for a batch.
+    """
+
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self._loop = None
+        self._pending = []
+        self._drainer = None
+
+    async def submit(self, api_key: str, system_prompt: str, user_prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # State left over from a previous event loop can never be resolved; start clean
+            self._loop, self._pending, self._drainer = loop, [], None
+        future = loop.create_future()
+        self._pending.append((api_key, system_prompt, user_prompt, future))
+        if self._drainer is None:
+            self._drainer = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self):
+        batch = []
+        try:
+            while self._pending:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                # Only requests sharing a key and system prompt can go in the same call
+                groups = {}
+                for job in batch:
+                    groups.setdefault(job[:2], []).append(job)
+                await asyncio.gather(*(
+                    self._dispatch(api_key, system_prompt, jobs)
+                    for (api_key, system_prompt), jobs in groups.items()
+                ))
+        except asyncio.CancelledError:
+            self._fail_all(batch, RuntimeError("Groq batch dispatch was cancelled"))
+            raise
+        except Exception as e:
+            # Never leave a caller waiting on a future nobody will resolve
+            self._fail_all(batch, e)
+        finally:
+            if self._drainer is asyncio.current_task():
+                self._drainer = None
+
+    def _fail_all(self, batch: list, error: Exception):
+        for job in batch + self._pending:
+            _resolve(job[3], error)
+        self._pending = []
+
+    async def _dispatch(self, api_key: str, system_prompt: str, jobs: list):
+        batched = {}
+        if len(jobs) > 1:
+            combined = "\n\n".join(f"### INPUT {i}\n{job[2]}" for i, job in enumerate(jobs))
+            try:
+                content = await _groq_chat(api_key, system_prompt + BATCH_PROMPT_SUFFIX, combined)
+                batched = orjson.loads(content)
+            except Exception:
+                # e.g. json_validate_failed or a too-large merged prompt: fall back to one call per job
+                logger.warning("Batched Groq call failed, retrying inputs individually", exc_info=True)
+            if not isinstance(batched, dict):
+                batched = {}
+
+        # Answer every caller whose slice came back, then re-ask the rest concurrently
+        pending = []
+        for i, job in enumerate(jobs):
+            item = batched.get(str(i))
+            if isinstance(item, dict):
+                _resolve(job[3], orjson.dumps(item).decode())
+            else:
+                pending.append(job)
+
+        results = await asyncio.gather(
+            *(_groq_chat(api_key, system_prompt, job[2]) for job in pending),
+            return_exceptions=True,
+        )
+        for job, result in zip(pending, results):
+            _resolve(job[3], result)
+
+def _resolve(future: asyncio.Future, result):
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+_placeholder_coalescer = _GroqCoalescer(GROQ_BATCH_MAX)
+
+# LRU of Groq responses so retries of the same audio + template skip the API
+_ai_cache = OrderedDict()
+_AI_CACHE_MAX = 256
+
+def _ai_cache_key(mode: str, *parts: str) -> str:
+    return hashlib.md5("|".join((mode,) + parts).encode("utf-8")).hexdigest()
+
+def _ai_cache_get(key: str):
+    if key in _ai_cache:
+        _ai_cache.move_to_end(key)
+        return _ai_cache[key]
+    return None
+
+def _ai_cache_put(key: str, value):
+    _ai_cache[key] = value
+    if len(_ai_cache) > _AI_CACHE_MAX:
+        _ai_cache.popitem(last=False)
+
+WHISPER_SIZE = os.environ.get("WHISPER_SIZE", "base")
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "auto")  # "auto", "cpu" or "cuda"
+WHISPER_BATCH_SIZE = 8
+WHISPER_BEAM_SIZE = 1
 
 # Global model instance to avoid reloading every request
 _whisper_model = None
+_whisper_pipeline = None
+_whisper_ready = False
+
+def _resolve_whisper_device() -> str:
+    if WHISPER_DEVICE != "auto":
+        return WHISPER_DEVICE
+    import ctranslate2
+    return "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
 
 def get_whisper_model():
     global _whisper_model
     if _whisper_model is None:
-        print("Loading Whisper model...")
-        _whisper_model = whisper.load_model("base")
+        logger.info("Loading Whisper model...")
+        device = _resolve_whisper_device()
+        # fp16 on GPU; CTranslate2 int8 kernels are several times faster than PyTorch on CPU
+        compute_type = "float16" if device == "cuda" else "int8"
+        _whisper_model = WhisperModel(WHISPER_SIZE, device=device, compute_type=compute_type, num_workers=1)
     return _whisper_model
 
+def get_whisper_pipeline():
+    global _whisper_pipeline
+    if _whisper_pipeline is None:
+        _whisper_pipeline = BatchedInferencePipeline(model=get_whisper_model())
+    return _whisper_pipeline
+
+def whisper_ready() -> bool:
+    """True once warm-up or a real transcription has completed on the request path."""
+    return _whisper_ready
+
+def _run_pipeline(audio) -> str:
+    # faster-whisper decodes the upload as-is via PyAV; the batched pipeline's default VAD
+    # splits out the speech, which is then decoded greedily, several chunks at a time
+    global _whisper_ready
+    segments, _ = get_whisper_pipeline().transcribe(audio, batch_size=WHISPER_BATCH_SIZE, beam_size=WHISPER_BEAM_SIZE)
+    text = " ".join(segment.text.strip() for segment in segments).strip()
+    _whisper_ready = True
+    return text
+
+def warm_up_whisper():
+    """Load everything the first upload would otherwise pay for: model, VAD model and batched path."""
+    silence = np.zeros(16000, dtype=np.float32)
+    # Silence loads the VAD model but yields no speech chunks, so run the greedy decoder once directly
+    segments, _ = get_whisper_model().transcribe(silence, beam_size=WHISPER_BEAM_SIZE, vad_filter=False)
+    list(segments)
+    _run_pipeline(silence)
+
 def transcribe_audio(file_path: str) -> str:
     """Transcribe audio file to text using Whisper."""
-    # Convert to wav if needed
-    if not file_path.lower().endswith('.wav'):
-        new_path = file_path.rsplit('.', 1)[0] + '.wav'
-        audio = AudioSegment.from_file(file_path)
-        audio.export(new_path, format="wav")
-        file_path = new_path
-    
-    model = get_whisper_model()
-    result = model.transcribe(file_path)
-    return result["text"].strip()
+    return _run_pipeline(file_path)
 
-def extract_placeholders(template_path: str) -> list:
-    """Extract placeholders from a docx template."""
+@dataclass(frozen=True)
+class TemplateHandle:
+    """A parsed template shared across requests. Callers must not mutate it."""
+    placeholders: tuple
+    text: str
+    document: Document  # pristine copy, never read directly
+
+    def new_document(self) -> Document:
+        """Private copy of the template to fill, without re-reading the .docx zip."""
+        return copy.deepcopy(self.document)
+
+def load_template(template_path: str) -> TemplateHandle:
+    """Parse a docx template once: placeholders, full text for the AI context, and the document itself."""
+    # mtime in the key means an overwritten template is re-parsed automatically
+    return _load_template_cached(template_path, os.path.getmtime(template_path))
+
+@lru_cache(maxsize=64)
+def _load_template_cached(template_path: str, mtime: float) -> TemplateHandle:
     doc = docx.Document(template_path)
+    # Copy before walking paragraphs: a Document whose lazy body proxy already exists
+    # deep-copies into a detached body, so edits to the copy would be lost on save
+    pristine = copy.deepcopy(doc)
     placeholders = set()
-    pattern = re.compile(r'\[([^\[\]]+)\]')
-    for para in doc.paragraphs:
-        matches = pattern.findall(para.text)
-        placeholders.update(matches)
-    return sorted(list(placeholders))
-
-def get_template_text(docx_path: str) -> str:
-    """Read full text from docx to give AI context."""
-    doc = docx.Document(docx_path)
     full_text = []
     for para in doc.paragraphs:
-        if para.text.strip():
-            full_text.append(para.text)
+        text = para.text
+        placeholders.update(PLACEHOLDER_RE.findall(text))
+        if text.strip():
+            full_text.append(text)
     # Also read tables
     for table in doc.tables:
         for row in table.rows:
@@ -70,12 +289,17 @@ def get_template_text(docx_path: str) -> str:
                     row_text.append(cell_text)
             if row_text:
                 full_text.append(" | ".join(row_text))
-    return "\n".join(full_text)
+    return TemplateHandle(tuple(sorted(placeholders)), "\n".join(full_text), pristine)
 
-def parse_transcript_with_ai(transcript: str, placeholders: list, api_key: str, template_text: str = "") -> dict:
+async def parse_transcript_with_ai(transcript: str, placeholders: list, api_key: str, template_text: str = "") -> dict:
     """Use Groq API to parse transcript into structured data."""
     if not placeholders:
         return {}
+
+    cache_key = _ai_cache_key("placeholders", transcript, template_text, ",".join(placeholders))
+    cached = _ai_cache_get(cache_key)
+    if cached is not None:
+        return cached
         
     placeholder_list = "\n".join(f"- {p}" for p in placeholders)
     
@@ -104,31 +328,26 @@ Extract data for these SPECIFIC fields (placeholders):
 
 Return ONLY a valid, flat JSON object mapping field names to string values."""
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": GROQ_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.1,
-        "response_format": {"type": "json_object"}
-    }
-    
-    response = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=60)
-    response.raise_for_status()
-    return response.json()['choices'][0]['message']['content']
+    if GROQ_BATCH_REQUESTS:
+        # Requests that queue up behind an in-flight call are folded into one Groq call
+        content = await _placeholder_coalescer.submit(api_key, system_prompt, user_prompt)
+    else:
+        content = await _groq_chat(api_key, system_prompt, user_prompt)
+    _ai_cache_put(cache_key, content)
+    return content
 
-def infer_and_fill_template(transcript: str, template_text: str, api_key: str) -> dict:
+async def infer_and_fill_template(transcript: str, template_text: str, api_key: str) -> dict:
     """
     For templates without placeholders:
     1. Identify field:original_value pairs from template_text.
     2. Extract new_value from transcript.
     3. Return { "field_name": { "original": "...", "new": "..." } }
     """
+    cache_key = _ai_cache_key("infer", transcript, template_text)
+    cached = _ai_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
     system_prompt = """You are an expert document analyzer.
 The user provides a FILLED template text (e.g. from a previous patient) and a new transcription.
 Your job is to:
@@ -150,70 +369,58 @@ New Transcription:
 
 Return JSON mapping fields to original/new values."""
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": GROQ_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.1,
-        "response_format": {"type": "json_object"}
-    }
-    
-    response = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=60)
-    response.raise_for_status()
-    return response.json()['choices'][0]['message']['content']
+    content = await _groq_chat(api_key, system_prompt, user_prompt)
+    _ai_cache_put(cache_key, content)
+    return content
 
 def generate_filled_docx(template_path: str, filled_data: dict, output_path: str, replacements: dict = None):
     """Fill template docx with data. Supports both placeholder replacement and direct text replacement."""
-    doc = docx.Document(template_path)
+    doc = load_template(template_path).new_document()
     
     clean_data = {k.strip(): str(v) for k, v in filled_data.items()}
 
     if replacements:
         # Smart Replacement Mode for non-placeholder templates
+        orig_to_new = {}
         for field, meta in replacements.items():
             original = meta.get("original")
             if not original:
                 continue
-                
             # Get latest value from filled_data, fallback to 'new' from AI
-            new_val = clean_data.get(field, meta.get("new", ""))
-            
+            orig_to_new.setdefault(original, clean_data.get(field, meta.get("new", "")))
+
+        if orig_to_new:
+            # One alternation for all originals, longest first so overlapping values match whole
+            originals_re = re.compile("|".join(map(re.escape, sorted(orig_to_new, key=len, reverse=True))))
+
+            def replace_paragraph(para):
+                text = para.text
+                if originals_re.search(text):
+                    para.text = originals_re.sub(lambda m: orig_to_new[m.group(0)], text)
+
+            # Walk the document once instead of once per field
             for para in doc.paragraphs:
-                if original in para.text:
-                    para.text = para.text.replace(original, new_val)
-            
+                replace_paragraph(para)
+
             for table in doc.tables:
                 for row in table.rows:
                     for cell in row.cells:
                         for para in cell.paragraphs:
-                            if original in para.text:
-                                para.text = para.text.replace(original, new_val)
+                            replace_paragraph(para)
     
     # Always try placeholder replacement too (hybrid support)
+    def fill_placeholder(match):
+        key = match.group(1).strip()
+        return clean_data[key] if key in clean_data else match.group(0)
+
     for para in doc.paragraphs:
         full_text = para.text
         if '[' not in full_text:
             continue
             
-        new_text = full_text
-        matches = re.findall(r'\[([^\[\]]+)\]', full_text)
-        
-        changed = False
-        for m in matches:
-            m_clean = m.strip()
-            if m_clean in clean_data:
-                bracket = f"[{m}]"
-                if bracket in new_text:
-                    new_text = new_text.replace(bracket, clean_data[m_clean])
-                    changed = True
-        
-        if not changed:
+        # Single pass over the paragraph; unknown placeholders are left as-is
+        new_text = PLACEHOLDER_RE.sub(fill_placeholder, full_text)
+        if new_text == full_text:
             continue
             
         # Nuclear replacement: Clear XML runs and rebuild